@@ -1,35 +1,62 @@
 import os
+import asyncio
+import atexit
+import functools
 import logging
+import random
+import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
+import httpx
 import openai
 
 from openai import APIError, RateLimitError
 
-import tempfile
-import os
-
 from telegram import Update, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes, JobQueue
+    MessageHandler, filters, ContextTypes, JobQueue,
+    PicklePersistence, PersistenceInput, AIORateLimiter
 )
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 
 from database import (
-    init_db, user_exists, set_master_password, verify_master_password,
-    save_voice_memo, get_user_memos, get_memo_file_id, delete_memo,
-    get_db_connection
+    init_db, is_known_user, user_exists, set_master_password, verify_master_password,
+    save_voice_memo, get_user_memos, get_memo_file_info, delete_memo,
+    get_memo_texts, save_memo_transcription, save_memo_summary,
+    save_user_activity, get_recent_activity
 )
 
 
-from dotenv import load_dotenv
-load_dotenv()
-
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# A populated environment (container, systemd) doesn't need the .env file read and parsed
+if not os.getenv("BOT_TOKEN"):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+# Handlers only enqueue log records; a background thread does the blocking stderr writes
+log_queue = SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+root_logger = logging.getLogger()
+root_logger.addHandler(QueueHandler(log_queue))
+root_logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+# httpx logs every Bot API request at INFO; only its warnings are worth the I/O
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log_listener = QueueListener(log_queue, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 
@@ -38,9 +65,15 @@ lemonfox_client = None
 if LEMONFOX_API_KEY:
     try:
         
-        lemonfox_client = openai.OpenAI(
+        lemonfox_client = openai.AsyncOpenAI(
             api_key=LEMONFOX_API_KEY,
-            base_url="https://api.lemonfox.ai/v1" 
+            base_url="https://api.lemonfox.ai/v1",
+            # One long-lived HTTP/2 pool: concurrent transcriptions and summaries share a
+            # connection instead of each paying for a new TLS handshake
+            http_client=openai.DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60.0),
+            ),
         )
         logger.info("OpenAI client configured for LemonFox.ai")
     except Exception as e:
@@ -49,14 +82,83 @@ else:
     logger.warning("⚠️ LEMONFOX_API_KEY not found in environment variables. AI features will be disabled or fail.")
 
 
+# Telegram HTTP pools: getUpdates long-polling gets its own small pool so it can
+# never occupy the connections needed for replies, edits and file downloads.
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "32"))
+TG_GETUPDATES_POOL_SIZE = int(os.getenv("TG_GETUPDATES_POOL_SIZE", "4"))
+TG_POOL_TIMEOUT = 10.0
+TG_KEEPALIVE_EXPIRY = 60.0
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5"))
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "20"))
+TG_WRITE_TIMEOUT = float(os.getenv("TG_WRITE_TIMEOUT", "20"))
+# Transient Bot API failures are retried with exponential backoff (0.5s, 1s, ...)
+TG_MAX_ATTEMPTS = 3
+TG_RETRY_BASE = 0.5
+TG_MAX_RETRY_AFTER = 30
+# deleteMessages accepts at most 100 message ids per call
+TG_DELETE_BATCH_SIZE = 100
+# Single deletes in flight at once when a batch delete falls back to one call per message
+TG_DELETE_FALLBACK_CONCURRENCY = 10
+delete_fallback_limit = asyncio.Semaphore(TG_DELETE_FALLBACK_CONCURRENCY)
+# Updates are processed as independent tasks so one slow chat never blocks another
+TG_CONCURRENT_UPDATES = int(os.getenv("TG_CONCURRENT_UPDATES", "256"))
+
+# Only the update types the bot has handlers for; Telegram filters the rest server-side
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+POLL_TIMEOUT = 50
+
+# With WEBHOOK_URL set, Telegram pushes updates to us; without it we fall back to polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Per-user conversation state (awaited input, unlocked flag) survives restarts
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "vaultbot_state.pickle")
+
+# Argon2id hashing is deliberately slow; run it on worker threads so the
+# event loop keeps serving other users while a password is set or checked.
+# argon2 and bcrypt release the GIL, so one thread per core hashes in parallel.
+kdf_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="kdf")
+# sqlite3 calls block too; they get their own pool so a burst of logins can't queue them
+db_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="db")
+# Failed unlocks per user within a fixed window; past the limit the KDF is not run at all
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_WINDOW = 60
+
+
+# Memo buttons share one pattern compiled once; re.ASCII keeps \d to the digits int() accepts.
+# Group 1 is the action, group 2 the memo id, which handlers read from context.matches.
+MEMO_ACTION_PATTERN = re.compile(r'^(transcribe|summarize|listen|delete)_(\d+)$', re.ASCII)
+
+
 AWAITING_PASSWORD = 1
 AWAITING_LOGIN = 2
 AWAITING_VOICE = 3
 
 
-user_activity = {}
+# Activity timestamps are only refreshed this often (seconds)
+ACTIVITY_DEBOUNCE = 5.0
+# ...and written to the DB this often, so a restart doesn't forget who was active
+ACTIVITY_PERSIST_INTERVAL = 60.0
+INACTIVITY_TIMEOUT = 300  # 5 minutes
+
+# Bot messages per user that the next cleanup deletes; only the newest few are kept
+TRACKED_MESSAGES_MAX = 10
+
+class UserState:
+    """Per-user session bookkeeping, kept in user_state in order of last activity"""
+    __slots__ = ('last_activity', 'persisted_at', 'chat_id', 'message_ids')
 
-user_last_messages = {}
+    def __init__(self, last_activity: float = 0.0, persisted_at: float = 0.0, chat_id: int = 0):
+        self.last_activity = last_activity
+        self.persisted_at = persisted_at
+        self.chat_id = chat_id
+        self.message_ids = deque(maxlen=TRACKED_MESSAGES_MAX)
+
+user_state: dict[int, UserState] = {}
+
+failed_logins = {}
 
 # --- Inline keyboards ---
 def get_start_inline_keyboard():
@@ -89,7 +191,9 @@ def get_back_to_menu_keyboard():
         [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_menu")]
     ])
 
-def get_memo_options_keyboard(memo_id):
+# Markups are immutable and the buttons depend only on memo_id, so one instance serves every user
+@functools.lru_cache(maxsize=4096)
+def get_memo_options_keyboard(memo_id: int) -> InlineKeyboardMarkup:
     """Keyboard with options for a specific memo"""
     return InlineKeyboardMarkup([
         [
@@ -103,51 +207,294 @@ def get_memo_options_keyboard(memo_id):
         [InlineKeyboardButton("🏠 Back to Menu", callback_data="back_to_menu")]
     ])
 
-# --- Utility Functions ---
-async def cleanup_old_messages(context, user_id, chat_id, exclude_message_id=None):
-    """Clean up old messages for a user, excluding a specific message if provided"""
-    if user_id in user_last_messages:
-        messages_to_delete = []
-        for msg_id in user_last_messages[user_id][:]: # Iterate over a copy
-            if exclude_message_id is not None and msg_id == exclude_message_id:
-                continue
-            messages_to_delete.append(msg_id)
-
-        for msg_id in messages_to_delete:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                user_last_messages[user_id].remove(msg_id)
-            except Exception as e:
-                logger.warning(f"Could not delete message {msg_id} for user {user_id}: {e}")
+# Static markups are built once; they are never mutated after construction
+START_KB = get_start_inline_keyboard()
+AUTH_KB = get_auth_inline_keyboard()
+MAIN_MENU_KB = get_main_menu_inline_keyboard()
+HELP_KB = get_help_inline_keyboard()
+BACK_TO_MENU_KB = get_back_to_menu_keyboard()
+# The memo list ends with the same back button, so it reuses this row instead of building one per render
+BACK_TO_MENU_ROW = BACK_TO_MENU_KB.inline_keyboard[0]
+
+# --- Static message texts ---
+WELCOME_TEXT = (
+    "🔒 Welcome to VaultBot! 🔒\n\n"
+    "Your secure, voice-based journal.\nEquiped with AI assisted transciption and summerization[openai's whisper model]\n"
+    "Click the button below to get started:"
+)
 
-        
-        if len(user_last_messages[user_id]) > 10:
-            user_last_messages[user_id] = user_last_messages[user_id][-5:]
+HELP_TEXT = (
+    "🤖 <b>VaultBot Help</b>\n\n"
+    "• <b>🎤 New Memo</b>: Record a new voice memo\n"
+    "• <b>📋 My Memos</b>: View your saved memos\n"
+    "• <b>🔐 Lock Vault</b>: Lock your vault for security\n"
+    "• <b>📝 Transcribe</b>: Convert speech to text (Powered by AI)\n"
+    "• <b>✨ Summarize</b>: Get an AI summary of your memo\n\n"
+    "Your data is encrypted and secure. Need more help?"
+)
 
-def update_user_activity(user_id):
-    
-    user_activity[user_id] = time.time()
+SET_PASSWORD_TEXT = "🔒 Welcome to VaultBot! 🔒\n\nYour secure, voice-based journal.\n\n📝 Please set your master password:"
 
-async def check_inactivity(context: ContextTypes.DEFAULT_TYPE):
-    
-    current_time = time.time()
-    inactive_users = []
+LOCKED_PROMPT_TEXT = "🔒 Vault is locked.\n\nPlease enter your master password to unlock:"
 
-    for user_id, last_activity in list(user_activity.items()): # Use list() to avoid RuntimeError during iteration
-        if current_time - last_activity > 300:  # 5 minutes
-            inactive_users.append(user_id)
+UNLOCKED_TEXT = "✅ Access granted!\n\n🔓 Your vault is now unlocked.\n\nWhat would you like to do?"
 
-    for user_id in inactive_users:
-       
-        if user_id in user_activity:
-            del user_activity[user_id]
+PASSWORD_TOO_SHORT_TEXT = "❌ Password must be at least 6 characters long.\nPlease try again:"
 
-        
-        if user_id in user_last_messages:
-            del user_last_messages[user_id]
+PASSWORD_SET_TEXT = "✅ Password set successfully!\n\n🔓 Your vault is now secured and ready to use.\n\nWhat would you like to do?"
 
-        logger.info(f"User {user_id} vault locked due to inactivity")
-        
+PLEASE_UNLOCK_TEXT = "🔒 Please unlock your vault first!"
+
+NEW_MEMO_TEXT = "🎤 Ready to record your memo!\n\nPlease send a voice message now."
+
+NO_MEMOS_TEXT = "📋 You don't have any memos yet.\n\nUse the 'New Memo' button to create your first voice memo!"
+
+MEMO_LIST_TEXT = "📋 Your memos:\n\nSelect a memo to listen to it:"
+
+AI_DISABLED_TEXT = "❌ AI features are not configured. Please check the bot setup."
+
+LOCKED_TEXT = "🔒 Vault locked.\n\nClick the button below to unlock when you're ready."
+
+AUTO_LOCKED_TEXT = "🔒 Vault locked after 5 minutes of inactivity.\n\nClick the button below to unlock when you're ready."
+
+MAIN_MENU_TEXT = "What would you like to do?"
+
+# --- Utility Functions ---
+# httpx failures that happen before the request reaches Telegram, so resending can't duplicate it
+UNSENT_REQUEST_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+def retry_on_network(max_attempts: int = TG_MAX_ATTEMPTS, base: float = TG_RETRY_BASE, idempotent: bool = True):
+    """Retry a Bot API coroutine on transient network errors and flood-control (429) replies"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    return await func(*args, **kwargs)
+                except BadRequest:
+                    raise  # BadRequest subclasses NetworkError but is never transient
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    if attempt == max_attempts or delay > TG_MAX_RETRY_AFTER:
+                        raise
+                    logger.warning(f"Flood control hit, retrying in {delay}s (attempt {attempt}/{max_attempts})")
+                except NetworkError as e:
+                    # A read timeout on a non-idempotent call may mean Telegram already acted on it
+                    if attempt == max_attempts or not (idempotent or isinstance(e.__cause__, UNSENT_REQUEST_ERRORS)):
+                        raise
+                    delay = base * 2 ** (attempt - 1) + random.uniform(0, 0.25)
+                    logger.warning(f"Telegram network error: {e}; retrying in {delay:.2f}s (attempt {attempt}/{max_attempts})")
+                await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+class RetryingHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest whose API calls and file downloads retry transient failures"""
+    # Bot API calls like sendMessage and deleteMessages aren't idempotent; file downloads are
+    post = retry_on_network(idempotent=False)(HTTPXRequest.post)
+    retrieve = retry_on_network()(HTTPXRequest.retrieve)
+
+class AwaitingTextFilter(filters.MessageFilter):
+    """Passes only messages from users whose conversation state is waiting for typed input"""
+    def __init__(self, user_data, states):
+        super().__init__(name="AwaitingTextFilter")
+        self.user_data = user_data
+        self.states = frozenset(states)
+
+    def filter(self, message) -> bool:
+        if message.from_user is None:
+            return False
+        data = self.user_data.get(message.from_user.id)
+        return data is not None and data.get('state') in self.states
+
+def build_bot_request(pool_size: int, http_version: str = "1.1", request_class=HTTPXRequest) -> HTTPXRequest:
+    """HTTPX transport for Bot API calls that keeps connections alive between requests"""
+    return request_class(
+        connection_pool_size=pool_size,
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=TG_READ_TIMEOUT,
+        write_timeout=TG_WRITE_TIMEOUT,
+        pool_timeout=TG_POOL_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=TG_KEEPALIVE_EXPIRY,
+            )
+        },
+    )
+
+def track_message(user_id, message_id):
+    """Remember a bot message so the user's next cleanup deletes it"""
+    state = user_state.get(user_id)
+    if state is None:
+        # E.g. the lock notice of a swept session: tracked for one more timeout, then evicted like any other
+        state = user_state[user_id] = UserState(last_activity=time.monotonic())
+    state.message_ids.append(message_id)
+
+async def reply_tracked(update, text, **kwargs):
+    """Reply to the update's message and track the reply for the next cleanup"""
+    message = await update.message.reply_text(text, **kwargs)
+    track_message(update.effective_user.id, message.message_id)
+    return message
+
+def cleanup_old_messages(context, user_id, chat_id, exclude_message_id=None):
+    """Clean up old messages for a user, excluding a specific message if provided"""
+    # Ids come off the list right away and are deleted in the background, so the handler never waits on it
+    state = user_state.get(user_id)
+    if state is None or not state.message_ids:
+        return
+    tracked = state.message_ids
+    messages_to_delete = [msg_id for msg_id in tracked if msg_id != exclude_message_id]
+    state.message_ids = deque((msg_id for msg_id in tracked if msg_id == exclude_message_id), maxlen=TRACKED_MESSAGES_MAX)
+    if messages_to_delete:
+        context.application.create_task(delete_tracked_messages(context, user_id, chat_id, messages_to_delete))
+
+async def delete_tracked_messages(context, user_id, chat_id, messages_to_delete):
+    """Delete messages in deleteMessages batches; ids that can't be deleted go back on the user's list"""
+    failed = []
+    for start in range(0, len(messages_to_delete), TG_DELETE_BATCH_SIZE):
+        batch = messages_to_delete[start:start + TG_DELETE_BATCH_SIZE]
+        try:
+            await context.bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            continue
+        except Exception as e:
+            logger.warning("Batch delete failed for user %s, deleting one by one: %s", user_id, e)
+        # Fall back to single deletes for this batch only, sent concurrently
+        results = await asyncio.gather(
+            *(delete_single_message(context, chat_id, msg_id) for msg_id in batch),
+            return_exceptions=True,
+        )
+        for msg_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not delete message %s for user %s: %s", msg_id, user_id, result)
+                failed.append(msg_id)
+
+    # Users evicted for inactivity have no entry left to put them back on
+    state = user_state.get(user_id)
+    if failed and state is not None:
+        state.message_ids = deque(failed + list(state.message_ids), maxlen=TRACKED_MESSAGES_MAX)
+
+async def delete_single_message(context, chat_id, message_id):
+    async with delete_fallback_limit:
+        return await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+async def run_db(func, *args):
+    """Run a blocking database call on the DB worker threads"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, func, *args)
+
+async def run_kdf(func, *args):
+    """Run a password hash or check on the KDF worker threads"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(kdf_executor, func, *args)
+
+async def lookup_user_exists(user_id):
+    """Answer known users from memory; only a first-time lookup queries the DB, off the event loop"""
+    if is_known_user(user_id):
+        return True
+    return await run_db(user_exists, user_id)
+
+async def edit_screen(query, text, reply_markup=None, **kwargs):
+    """Edit the callback's message, skipping the API call when it already shows this screen"""
+    current = query.message
+    same_text = getattr(current, 'text', None) == text
+    if same_text and getattr(current, 'reply_markup', None) == reply_markup:
+        return
+    try:
+        if same_text:
+            # Only the keyboard differs, so send just the markup
+            await query.edit_message_reply_markup(reply_markup=reply_markup)
+        else:
+            await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+async def delete_message_quietly(message):
+    """Delete a message, ignoring ones the bot can no longer delete"""
+    try:
+        await message.delete()
+    except BadRequest as e:
+        logger.warning("Could not delete message %s: %s", message.message_id, e)
+
+def begin_login_attempt(user_id):
+    """Count an unlock attempt up front; False if the user has used up the attempts for the current window"""
+    now = time.monotonic()
+    # Entries keep their insertion order, so expired windows are always at the front
+    while failed_logins:
+        oldest_id, (_, window_start) = next(iter(failed_logins.items()))
+        if now - window_start < LOGIN_WINDOW:
+            break
+        del failed_logins[oldest_id]
+    count, window_start = failed_logins.get(user_id, (0, now))
+    if count >= LOGIN_MAX_ATTEMPTS:
+        return False
+    failed_logins[user_id] = (count + 1, window_start)
+    return True
+
+def update_user_activity(user_id, chat_id):
+    """Record activity at most once per ACTIVITY_DEBOUNCE seconds; the 5 minute timeout doesn't need more"""
+    now = time.monotonic()
+    state = user_state.get(user_id)
+    if state is None:
+        state = UserState()
+    elif now - state.last_activity <= ACTIVITY_DEBOUNCE:
+        state.chat_id = chat_id
+        return
+    else:
+        del user_state[user_id]
+    # Re-inserting keeps user_state ordered by last activity, oldest first
+    user_state[user_id] = state
+    state.last_activity = now
+    state.chat_id = chat_id
+    if now - state.persisted_at > ACTIVITY_PERSIST_INTERVAL:
+        state.persisted_at = now
+        db_executor.submit(save_user_activity, user_id, time.time(), chat_id)
+
+async def check_inactivity(context: ContextTypes.DEFAULT_TYPE):
+    
+    cutoff = time.monotonic() - INACTIVITY_TIMEOUT
+    inactive_users = []
+    # Sessions are ordered by last activity, so the scan stops at the first one still active
+    for user_id, state in user_state.items():
+        if state.last_activity >= cutoff:
+            break
+        inactive_users.append((user_id, state))
+
+    calls = []
+    locked_users = []
+    for user_id, state in inactive_users:
+        del user_state[user_id]
+        user_data = context.application.user_data.get(user_id)
+        # Unauthenticated sessions are only forgotten; their welcome or password prompt stays usable
+        if user_data and user_data.get('authenticated'):
+            user_data['authenticated'] = False
+            user_data['state'] = None
+            locked_users.append(user_id)
+            if state.chat_id:
+                if state.message_ids:
+                    calls.append(delete_tracked_messages(context, user_id, state.chat_id, list(state.message_ids)))
+                calls.append(send_lock_notice(context, user_id, state.chat_id))
+            logger.info("User %s vault locked due to inactivity", user_id)
+
+    # The job isn't tied to these users, so persistence has to be told their data changed
+    if locked_users:
+        context.application.mark_data_for_update_persistence(user_ids=locked_users)
+
+    # Every inactive chat's deletes and lock notices go out at once rather than user by user
+    if calls:
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("Inactivity cleanup call failed: %s", result)
+
+async def send_lock_notice(context, user_id, chat_id):
+    message = await context.bot.send_message(chat_id=chat_id, text=AUTO_LOCKED_TEXT, reply_markup=AUTH_KB)
+    track_message(user_id, message.message_id)
 
 # --- Main Bot Class ---
 class VaultBot:
@@ -157,7 +504,54 @@ class VaultBot:
             logger.error("❌ CRITICAL: No BOT_TOKEN found in environment variables")
             raise ValueError("Bot token not found in environment variables")
 
-        self.application = Application.builder().token(self.token).build()
+        # Free-text messages are routed by conversation state with one dict lookup
+        self.text_routes = {
+            AWAITING_PASSWORD: self.handle_password_input,
+            AWAITING_LOGIN: self.handle_login_input,
+        }
+
+        # Callbacks with fixed data: (handler, needs_cleanup). Screens that only edit the
+        # current message leave older tracked messages for the next cleanup; lock cleans up itself.
+        # The flag only controls deletes: the shared preamble records activity and chat for every route
+        self.callback_routes = {
+            "start_bot": (self.start_bot, True),
+            "unlock_vault": (self.unlock_vault, False),
+            "new_memo": (self.new_memo_handler, False),
+            "my_memos": (self.my_memos_handler, True),
+            "help": (self.help_handler, False),
+            "lock_vault": (self.lock_handler, False),
+            "back_to_menu": (self.back_to_menu_handler, False),
+            "back_to_memos": (self.my_memos_handler, True),
+        }
+
+        # Memo buttons by action; transcribe and summarize answer the query themselves
+        self.memo_routes = {
+            "transcribe": self.transcribe_memo_handler,
+            "summarize": self.summarize_memo_handler,
+            "listen": self.callback_handler(self.listen_memo_handler, answer=False),
+            "delete": self.callback_handler(self.delete_memo_handler, answer=False),
+        }
+
+        self.application = (
+            Application.builder()
+            .token(self.token)
+            .request(build_bot_request(TG_POOL_SIZE, http_version="2", request_class=RetryingHTTPXRequest))
+            .get_updates_request(build_bot_request(TG_GETUPDATES_POOL_SIZE))
+            .concurrent_updates(TG_CONCURRENT_UPDATES)
+            # Throttle outgoing calls to Telegram's published limits before they turn into 429s.
+            # 429s that still get through are retried by RetryingHTTPXRequest, so the limiter doesn't retry too
+            .rate_limiter(AIORateLimiter(
+                overall_max_rate=30, overall_time_period=1,
+                group_max_rate=20, group_time_period=60,
+                max_retries=0,
+            ))
+            .persistence(PicklePersistence(
+                filepath=PERSISTENCE_FILE,
+                store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            ))
+            .post_init(self.post_init)
+            .build()
+        )
         self.setup_handlers()
 
        
@@ -172,236 +566,210 @@ class VaultBot:
        
         self.application.add_handler(CommandHandler("start", self.start_command_handler))
 
-        self.application.add_handler(CallbackQueryHandler(self.transcribe_memo_handler, pattern=r'^transcribe_\d+$'))
-        self.application.add_handler(CallbackQueryHandler(self.summarize_memo_handler, pattern=r'^summarize_\d+$'))
+        # All fixed callback data shares one handler: the pattern is a membership test on the
+        # route table and route_callback dispatches with a single dict lookup
+        self.application.add_handler(CallbackQueryHandler(self.callback_handler(self.route_callback, cleanup=False), pattern=self.callback_routes.__contains__))
+        # Memo buttons are matched by one regex and dispatched on its action group
+        self.application.add_handler(CallbackQueryHandler(self.route_memo_action, pattern=MEMO_ACTION_PATTERN))
 
-        self.application.add_handler(CallbackQueryHandler(self.inline_button_handler, pattern=".*"))
+        # Buttons on outdated messages still get answered so the client stops waiting
+        self.application.add_handler(CallbackQueryHandler(self.stale_callback_handler))
 
         
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text_input))
+        # Text is only dispatched while a password is awaited; anything else is dropped by the filter
+        awaiting_text = AwaitingTextFilter(self.application.user_data, self.text_routes)
+        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & awaiting_text, self.handle_text_input))
         self.application.add_handler(MessageHandler(filters.VOICE, self.handle_voice_message))
 
     
     async def start_command_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.user_data.clear()
         user_id = update.effective_user.id
-        update_user_activity(user_id)
-        await cleanup_old_messages(context, user_id, update.effective_chat.id)
+        update_user_activity(user_id, update.effective_chat.id)
+        cleanup_old_messages(context, user_id, update.effective_chat.id)
         await self.show_welcome_message(update, context)
 
     async def show_welcome_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        welcome_text = (
-            "🔒 Welcome to VaultBot! 🔒\n\n"
-            "Your secure, voice-based journal.\nEquiped with AI assisted transciption and summerization[openai's whisper model]\n"
-            "Click the button below to get started:"
-        )
         if update.message:
-            message = await update.message.reply_text(welcome_text, parse_mode='HTML', reply_markup=get_start_inline_keyboard())
-            user_id = update.effective_user.id
-            if user_id not in user_last_messages:
-                user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+            await reply_tracked(update, WELCOME_TEXT, reply_markup=START_KB)
         else: # Callback query
             query = update.callback_query
-            await query.edit_message_text(welcome_text, parse_mode='HTML', reply_markup=get_start_inline_keyboard())
+            await query.edit_message_text(WELCOME_TEXT, reply_markup=START_KB)
 
-    async def inline_button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        query = update.callback_query
-        await query.answer()
-        user_id = query.from_user.id
-        update_user_activity(user_id)
-        current_message_id = query.message.message_id
-        await cleanup_old_messages(context, user_id, query.message.chat_id, current_message_id)
-
-        # Route based on callback_data
-        if query.data == "start_bot":
-            await self.start_bot(query, context)
-        elif query.data == "unlock_vault":
-            await self.unlock_vault(query, context)
-        elif query.data == "new_memo":
-            await self.new_memo_handler(query, context)
-        elif query.data == "my_memos":
-            await self.my_memos_handler(query, context)
-        elif query.data == "help":
-            await self.help_handler(query, context)
-        elif query.data == "lock_vault":
-            await self.lock_handler(query, context)
-        elif query.data == "back_to_menu":
-            await self.back_to_menu_handler(query, context)
-        elif query.data == "back_to_memos":
-            await self.my_memos_handler(query, context)
-        elif query.data.startswith("listen_"):
-            await self.listen_memo_handler(query, context)
-        elif query.data.startswith("delete_"):
-            await self.delete_memo_handler(query, context)
-        # transcribe_ and summarize_ are handled by dedicated handlers
+    def callback_handler(self, handler, answer=True, cleanup=True):
+        """Wrap a (query, context) handler for CallbackQueryHandler with the shared button preamble"""
+        # A query can only be answered once; handlers that show their own toast pass answer=False
+        async def run(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            query = update.callback_query
+            if answer:
+                await query.answer()
+            user_id = query.from_user.id
+            update_user_activity(user_id, query.message.chat_id)
+            if cleanup:
+                cleanup_old_messages(context, user_id, query.message.chat_id, query.message.message_id)
+            await handler(query, context)
+        return run
+
+    async def route_callback(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
+        handler, needs_cleanup = self.callback_routes[query.data]
+        if needs_cleanup:
+            cleanup_old_messages(context, query.from_user.id, query.message.chat_id, query.message.message_id)
+        await handler(query, context)
+
+    async def route_memo_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await self.memo_routes[context.matches[0].group(1)](update, context)
+
+    async def stale_callback_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await update.callback_query.answer()
+
+    async def _prompt_set_password(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await query.edit_message_text(SET_PASSWORD_TEXT)
+        context.user_data['state'] = AWAITING_PASSWORD
+
+    async def _prompt_login(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await query.edit_message_text(LOCKED_PROMPT_TEXT)
+        context.user_data['state'] = AWAITING_LOGIN
 
     async def start_bot(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
-        user_id = query.from_user.id
-        if not user_exists(user_id):
-            await query.edit_message_text("🔒 Welcome to VaultBot! 🔒\n\nYour secure, voice-based journal.\n\n📝 Please set your master password:", parse_mode='HTML')
-            context.user_data['state'] = AWAITING_PASSWORD
+        if await lookup_user_exists(query.from_user.id):
+            await self._prompt_login(query, context)
         else:
-            await query.edit_message_text("🔒 Vault is locked.\n\nPlease enter your master password to unlock:", parse_mode='HTML')
-            context.user_data['state'] = AWAITING_LOGIN
+            await self._prompt_set_password(query, context)
 
     async def unlock_vault(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
-        user_id = query.from_user.id
-        if user_exists(user_id):
-            await query.edit_message_text("🔒 Vault is locked.\n\nPlease enter your master password to unlock:", parse_mode='HTML')
-            context.user_data['state'] = AWAITING_LOGIN
+        if await lookup_user_exists(query.from_user.id):
+            await self._prompt_login(query, context)
         else:
-            await query.edit_message_text("You need to set up your vault first!\n\nClick the button below to get started:", parse_mode='HTML', reply_markup=get_start_inline_keyboard())
+            await query.edit_message_text("You need to set up your vault first!\n\nClick the button below to get started:", reply_markup=START_KB)
 
     async def handle_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = update.effective_user.id
         text = update.message.text
         current_state = context.user_data.get('state')
-        update_user_activity(user_id)
-        await cleanup_old_messages(context, user_id, update.effective_chat.id)
-        logger.info(f"User {user_id} in state {current_state} entered text: {text}")
+        update_user_activity(user_id, update.effective_chat.id)
+        cleanup_old_messages(context, user_id, update.effective_chat.id)
+        # Text here is usually a master password, so only its length is ever logged
+        logger.debug("User %s in state %s entered text: <redacted len=%d>", user_id, current_state, len(text))
 
-        if current_state == AWAITING_PASSWORD:
-            await self.handle_password_input(update, context, text)
-        elif current_state == AWAITING_LOGIN:
-            await self.handle_login_input(update, context, text)
+        handler = self.text_routes.get(current_state)
+        if handler:
+            # Don't leave the password sitting in the chat history; deletion runs in the background
+            context.application.create_task(delete_message_quietly(update.message), update=update)
+            await handler(update, context, text)
 
     async def handle_password_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, password: str) -> None:
         user_id = update.effective_user.id
         if len(password) < 6:
-            message = await update.message.reply_text("❌ Password must be at least 6 characters long.\nPlease try again:", reply_markup=ReplyKeyboardRemove())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+            await reply_tracked(update, PASSWORD_TOO_SHORT_TEXT, reply_markup=ReplyKeyboardRemove())
             return
-        if set_master_password(user_id, password):
-            message = await update.message.reply_text("✅ Password set successfully!\n\n🔓 Your vault is now secured and ready to use.\n\nWhat would you like to do?", parse_mode='HTML', reply_markup=get_main_menu_inline_keyboard())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+        if await run_kdf(set_master_password, user_id, password):
+            await reply_tracked(update, PASSWORD_SET_TEXT, reply_markup=MAIN_MENU_KB)
             context.user_data['state'] = None
             context.user_data['authenticated'] = True
         else:
-            message = await update.message.reply_text("❌ Failed to set password. Please try again.", parse_mode='HTML')
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+            await reply_tracked(update, "❌ Failed to set password. Please try again.")
 
     async def handle_login_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, password: str) -> None:
         user_id = update.effective_user.id
-        if verify_master_password(user_id, password):
-            message = await update.message.reply_text("✅ Access granted!\n\n🔓 Your vault is now unlocked.\n\nWhat would you like to do?", parse_mode='HTML', reply_markup=get_main_menu_inline_keyboard())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+        # The attempt is counted before the KDF runs, so concurrent guesses can't all slip past the limit
+        if not begin_login_attempt(user_id):
+            await reply_tracked(update, "⏳ Too many attempts.\n\nPlease wait a minute and try again.", reply_markup=AUTH_KB)
+            return
+        if await run_kdf(verify_master_password, user_id, password):
+            failed_logins.pop(user_id, None)
+            await reply_tracked(update, UNLOCKED_TEXT, reply_markup=MAIN_MENU_KB)
             context.user_data['state'] = None
             context.user_data['authenticated'] = True
         else:
-            message = await update.message.reply_text("❌ Incorrect password.\n\nPlease try again:", parse_mode='HTML', reply_markup=get_auth_inline_keyboard())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+            await reply_tracked(update, "❌ Incorrect password.\n\nPlease try again:", reply_markup=AUTH_KB)
 
     async def handle_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = update.effective_user.id
-        update_user_activity(user_id)
-        await cleanup_old_messages(context, user_id, update.effective_chat.id)
+        update_user_activity(user_id, update.effective_chat.id)
+        cleanup_old_messages(context, user_id, update.effective_chat.id)
 
         if not context.user_data.get('authenticated') or context.user_data.get('state') != AWAITING_VOICE:
-            message = await update.message.reply_text("🔒 Please start by unlocking your vault and selecting 'New Memo'.", parse_mode='HTML', reply_markup=get_auth_inline_keyboard())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+            await reply_tracked(update, "🔒 Please start by unlocking your vault and selecting 'New Memo'.", reply_markup=AUTH_KB)
             return
 
         voice = update.message.voice
         file_id = voice.file_id
 
-        if save_voice_memo(user_id, file_id):
-            message = await update.message.reply_text("✅ Memo saved!\n\nYour voice message has been securely stored.", parse_mode='HTML', reply_markup=get_back_to_menu_keyboard())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+        if await run_db(save_voice_memo, user_id, file_id):
+            await reply_tracked(update, "✅ Memo saved!\n\nYour voice message has been securely stored.", reply_markup=BACK_TO_MENU_KB)
             context.user_data['state'] = None
         else:
-            message = await update.message.reply_text("❌ Failed to save memo. Please try again.", parse_mode='HTML', reply_markup=get_main_menu_inline_keyboard())
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(message.message_id)
+            await reply_tracked(update, "❌ Failed to save memo. Please try again.", reply_markup=MAIN_MENU_KB)
 
     async def new_memo_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not context.user_data.get('authenticated'):
-            await query.edit_message_text("🔒 Please unlock your vault first!", parse_mode='HTML', reply_markup=get_auth_inline_keyboard())
+            await query.edit_message_text(PLEASE_UNLOCK_TEXT, reply_markup=AUTH_KB)
             return
         context.user_data['state'] = AWAITING_VOICE
-        await query.edit_message_text("🎤 Ready to record your memo!\n\nPlease send a voice message now.", parse_mode='HTML')
+        await query.edit_message_text(NEW_MEMO_TEXT)
 
     async def my_memos_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not context.user_data.get('authenticated'):
-            await query.edit_message_text("🔒 Please unlock your vault first!", parse_mode='HTML', reply_markup=get_auth_inline_keyboard())
+            await query.edit_message_text(PLEASE_UNLOCK_TEXT, reply_markup=AUTH_KB)
             return
 
         user_id = query.from_user.id
-        memos = get_user_memos(user_id)
+        memos = await run_db(get_user_memos, user_id)
 
         if not memos:
-            await query.edit_message_text("📋 You don't have any memos yet.\n\nUse the 'New Memo' button to create your first voice memo!", parse_mode='HTML', reply_markup=get_main_menu_inline_keyboard())
+            await query.edit_message_text(NO_MEMOS_TEXT, reply_markup=MAIN_MENU_KB)
             return
 
-        keyboard = []
-        for memo in memos:
-            memo_date = memo['date'].split()[0] if ' ' in memo['date'] else memo['date']
-            keyboard.append([InlineKeyboardButton(f"🎵 Memo {memo['id']} ({memo_date})", callback_data=f"listen_{memo['id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_menu")])
+        keyboard = [
+            [InlineKeyboardButton(f"🎵 Memo {memo['id']} ({memo['day']})", callback_data=f"listen_{memo['id']}")]
+            for memo in memos
+        ]
+        keyboard.append(BACK_TO_MENU_ROW)
 
-        await query.edit_message_text("📋 Your memos:\n\nSelect a memo to listen to it:", parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text(MEMO_LIST_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def listen_memo_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = query.from_user.id
         chat_id = query.message.chat_id
         message_id = query.message.message_id
 
-        try:
-            memo_id = int(query.data.replace("listen_", ""))
-        except ValueError:
-            await query.answer("Invalid memo ID")
-            return
+        memo_id = int(context.matches[0].group(2))
 
-        file_id = get_memo_file_id(memo_id, user_id)
-        if not file_id:
+        info = await run_db(get_memo_file_info, memo_id, user_id)
+        if not info:
             await query.answer("Memo not found or access denied", show_alert=True)
             return
+        file_id, memo_date = info
 
         try:
             voice_message = await context.bot.send_voice(chat_id=chat_id, voice=file_id)
-            if user_id not in user_last_messages: user_last_messages[user_id] = []
-            user_last_messages[user_id].append(voice_message.message_id)
+            track_message(user_id, voice_message.message_id)
             await query.answer("Playing your memo...")
         except Exception as e:
             logger.error(f"Error sending voice message: {e}")
             await query.answer("Error playing memo", show_alert=True)
             return
 
-        memo_date = ""
-        memos = get_user_memos(user_id)
-        for memo in memos:
-            if memo['id'] == memo_id:
-                memo_date = memo['date'].split()[0] if ' ' in memo['date'] else memo['date']
-                break
-
-        options_message = await context.bot.send_message(chat_id=chat_id, text=f"🔊 Memo #{memo_id} ({memo_date})\n\nWhat would you like to do with this memo?", parse_mode='HTML', reply_markup=get_memo_options_keyboard(memo_id))
-        if user_id not in user_last_messages: user_last_messages[user_id] = []
-        user_last_messages[user_id].append(options_message.message_id)
-
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            if user_id in user_last_messages and message_id in user_last_messages[user_id]:
-                user_last_messages[user_id].remove(message_id)
-        except Exception as e:
-            logger.warning(f"Could not delete memo list message: {e}")
+        # Showing the options and removing the list don't depend on each other, so both go out at once
+        options_message, deleted = await asyncio.gather(
+            context.bot.send_message(chat_id=chat_id, text=f"🔊 Memo #{memo_id} ({memo_date})\n\nWhat would you like to do with this memo?", reply_markup=get_memo_options_keyboard(memo_id)),
+            context.bot.delete_message(chat_id=chat_id, message_id=message_id),
+            return_exceptions=True,
+        )
+        if isinstance(deleted, Exception):
+            logger.warning(f"Could not delete memo list message: {deleted}")
+        elif user_id in user_state and message_id in user_state[user_id].message_ids:
+            user_state[user_id].message_ids.remove(message_id)
+        if isinstance(options_message, Exception):
+            raise options_message
+        track_message(user_id, options_message.message_id)
 
     async def delete_memo_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = query.from_user.id
-        try:
-            memo_id = int(query.data.replace("delete_", ""))
-        except ValueError:
-            await query.answer("Invalid memo ID")
-            return
-        if delete_memo(memo_id, user_id):
+        memo_id = int(context.matches[0].group(2))
+        if await run_db(delete_memo, memo_id, user_id):
             await query.answer(f"Memo #{memo_id} deleted")
-            await self.my_memos_handler(query, context) # Refresh list
+            await self.my_memos_handler(query, context) # Refresh list from the cache, already without this memo
         else:
             await query.answer("Failed to delete memo", show_alert=True)
 
@@ -412,62 +780,47 @@ class VaultBot:
         await query.answer()
         user_id = query.from_user.id
         chat_id = query.message.chat_id
-        update_user_activity(user_id) # Update activity on interaction
+        update_user_activity(user_id, chat_id) # Update activity on interaction
 
         if not LEMONFOX_API_KEY or not lemonfox_client:
-            await query.edit_message_text("❌ AI features are not configured. Please check the bot setup.", reply_markup=get_main_menu_inline_keyboard())
+            await query.edit_message_text(AI_DISABLED_TEXT, reply_markup=MAIN_MENU_KB)
             await query.answer("AI Not Configured", show_alert=True)
             return
 
-        try:
-            memo_id = int(query.data.split('_')[1])
-        except (ValueError, IndexError):
-            await query.edit_message_text("❌ Invalid memo ID.", reply_markup=get_main_menu_inline_keyboard())
-            return
+        memo_id = int(context.matches[0].group(2))
 
         # Fetch file_id and check ownership
-        file_id = get_memo_file_id(memo_id, user_id)
-        if not file_id:
-            await query.edit_message_text("❌ Memo not found or access denied.", reply_markup=get_main_menu_inline_keyboard())
+        info = await run_db(get_memo_file_info, memo_id, user_id)
+        if not info:
+            await query.edit_message_text("❌ Memo not found or access denied.", reply_markup=MAIN_MENU_KB)
             return
+        file_id = info[0]
 
         # Check if already transcribed
-        conn = None
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT transcription FROM memos WHERE id = ? AND user_id = ?", (memo_id, user_id))
-            row = cursor.fetchone()
-            if row and row[0]:
-                transcription = row[0]
-                await query.edit_message_text(text=f"📝 Already transcribed:\n\n{transcription}", reply_markup=get_memo_options_keyboard(memo_id))
-                return
-        finally:
-            if conn:
-                conn.close()
+        texts = await run_db(get_memo_texts, memo_id, user_id)
+        transcription = texts[0] if texts else None
+        if transcription:
+            await query.edit_message_text(text=f"📝 Already transcribed:\n\n{transcription}", reply_markup=get_memo_options_keyboard(memo_id))
+            return
 
         # --- Transcription Process ---
-        tmp_path = None
         try:
             await query.edit_message_text("⏳ Transcribing your memo... Please wait.")
 
+            # Keep the voice file in memory; it goes straight to Whisper without touching disk
             file = await context.bot.get_file(file_id)
-            with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as tmp_file:
-                await file.download_to_drive(tmp_file.name)
-                tmp_path = tmp_file.name
+            audio_bytes = bytes(await file.download_as_bytearray())
 
-           
             logger.info(f"Calling LemonFox Whisper for memo {memo_id} (user {user_id})")
-            with open(tmp_path, "rb") as audio_file:
-                
-                transcript_response = lemonfox_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="verbose_json" 
-                )
+            transcript_response = await lemonfox_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=("memo.ogg", audio_bytes),
+                # Plain json skips the per-segment timestamps and log-probs we never read
+                response_format="json"
+            )
 
             transcription_text = transcript_response.text.strip()
-            detected_language = getattr(transcript_response, 'language', "unknown") # Safer way to get attribute
+            detected_language = getattr(transcript_response, 'language', None) or "unknown" # Only present if the provider includes it
 
             logger.info(f"LemonFox Whisper transcription complete for memo {memo_id}. Language: {detected_language}")
 
@@ -484,11 +837,7 @@ class VaultBot:
                 return
 
             # Save to DB
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("UPDATE memos SET transcription = ? WHERE id = ? AND user_id = ?", (transcription_text, memo_id, user_id))
-            conn.commit()
-            conn.close()
+            await run_db(save_memo_transcription, memo_id, user_id, transcription_text)
 
             
             await query.edit_message_text(text=f"📝 Transcription:\n\n{transcription_text}", reply_markup=get_memo_options_keyboard(memo_id))
@@ -504,23 +853,11 @@ class VaultBot:
             error_msg = f"❌ Transcription failed: API Error - {str(api_err)[:150]}"
             await query.edit_message_text(error_msg, reply_markup=get_memo_options_keyboard(memo_id))
             await query.answer("API Error", show_alert=True)
-        except FileNotFoundError:
-             logger.error(f"Temporary file not found for memo {memo_id} (user {user_id})")
-             error_msg = "❌ Transcription failed: Could not process audio file."
-             await query.edit_message_text(error_msg, reply_markup=get_memo_options_keyboard(memo_id))
-             await query.answer("File Error", show_alert=True)
         except Exception as e:
             logger.error(f"Unexpected error during transcription for memo {memo_id}, user {user_id}: {e}", exc_info=True)
             error_msg = f"❌ Transcription failed unexpectedly: {str(e)[:200]}"
             await query.edit_message_text(error_msg, reply_markup=get_memo_options_keyboard(memo_id))
             await query.answer("Transcription Failed", show_alert=True)
-        finally:
-            
-            if tmp_path and os.path.exists(tmp_path):
-                try:
-                    os.unlink(tmp_path)
-                except OSError as e:
-                     logger.warning(f"Could not delete temporary file {tmp_path}: {e}")
 
     async def summarize_memo_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle summarization of a memo using LemonFox LLM"""
@@ -528,52 +865,29 @@ class VaultBot:
         await query.answer()
         user_id = query.from_user.id
         chat_id = query.message.chat_id
-        update_user_activity(user_id) 
+        update_user_activity(user_id, chat_id) 
 
         if not LEMONFOX_API_KEY or not lemonfox_client:
-            await query.edit_message_text("❌ AI features are not configured. Please check the bot setup.", reply_markup=get_main_menu_inline_keyboard())
+            await query.edit_message_text(AI_DISABLED_TEXT, reply_markup=MAIN_MENU_KB)
             await query.answer("AI Not Configured", show_alert=True)
             return
 
-        try:
-            memo_id = int(query.data.split('_')[1])
-        except (ValueError, IndexError):
-            await query.edit_message_text("❌ Invalid memo ID.", reply_markup=get_main_menu_inline_keyboard())
-            return
-
-        
-        conn = None
-        transcription_text = None
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-
-            
-            cursor.execute("SELECT transcription FROM memos WHERE id = ? AND user_id = ?", (memo_id, user_id))
-            row = cursor.fetchone()
-            if row and row[0]:
-                transcription_text = row[0]
-            else:
-               
-                logger.info(f"No transcription found for memo {memo_id}, triggering transcription first.")
-                
-                update.callback_query.data = f"transcribe_{memo_id}"
-                await self.transcribe_memo_handler(update, context)
-               
-                return
+        memo_id = int(context.matches[0].group(2))
 
-            # Check if already summarized
-            cursor.execute("SELECT summary FROM memos WHERE id = ? AND user_id = ?", (memo_id, user_id))
-            row = cursor.fetchone()
-            if row and row[0]:
-                summary = row[0]
-                await query.edit_message_text(text=f"📝 Transcription:\n\n{transcription_text}\n\n✨ Summary:\n\n{summary}", reply_markup=get_memo_options_keyboard(memo_id))
-                await query.answer("✅ Summary loaded!")
-                return
+        # Transcription and summary come back from one query
+        texts = await run_db(get_memo_texts, memo_id, user_id)
+        transcription_text, summary = texts if texts else (None, None)
+        if not transcription_text:
+            logger.info(f"No transcription found for memo {memo_id}, triggering transcription first.")
+            # context.matches carries the same memo id into the transcribe handler
+            await self.transcribe_memo_handler(update, context)
+            return
 
-        finally:
-            if conn:
-                conn.close()
+        # Check if already summarized
+        if summary:
+            await query.edit_message_text(text=f"📝 Transcription:\n\n{transcription_text}\n\n✨ Summary:\n\n{summary}", reply_markup=get_memo_options_keyboard(memo_id))
+            await query.answer("✅ Summary loaded!")
+            return
 
         # --- Summarization Process ---
         try:
@@ -582,7 +896,7 @@ class VaultBot:
             
             logger.info(f"Calling LemonFox LLM for summary of memo {memo_id} (user {user_id})")
             
-            response = lemonfox_client.chat.completions.create(
+            response = await lemonfox_client.chat.completions.create(
                 model="llama3-8b", 
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant that summarizes voice memos concisely."},
@@ -595,11 +909,7 @@ class VaultBot:
             logger.info(f"LemonFox LLM summary complete for memo {memo_id}.")
 
             # Save to DB
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("UPDATE memos SET summary = ? WHERE id = ? AND user_id = ?", (summary, memo_id, user_id))
-            conn.commit()
-            conn.close()
+            await run_db(save_memo_summary, memo_id, user_id, summary)
 
             # Update message with transcription and summary
             await query.edit_message_text(text=f"📝 Transcription:\n\n{transcription_text}\n\n✨ Summary:\n\n{summary}", reply_markup=get_memo_options_keyboard(memo_id))
@@ -623,38 +933,64 @@ class VaultBot:
 
     # --- Other Handlers ---
     async def help_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
-        help_text = (
-            "🤖 <b>VaultBot Help</b>\n\n"
-            "• <b>🎤 New Memo</b>: Record a new voice memo\n"
-            "• <b>📋 My Memos</b>: View your saved memos\n"
-            "• <b>🔐 Lock Vault</b>: Lock your vault for security\n"
-            "• <b>📝 Transcribe</b>: Convert speech to text (Powered by AI)\n"
-            "• <b>✨ Summarize</b>: Get an AI summary of your memo\n\n"
-            "Your data is encrypted and secure. Need more help?"
-        )
-        await query.edit_message_text(help_text, parse_mode='HTML', reply_markup=get_help_inline_keyboard())
+        await query.edit_message_text(HELP_TEXT, parse_mode='HTML', reply_markup=HELP_KB)
 
     async def lock_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.user_data['authenticated'] = False
         context.user_data['state'] = None
         user_id = query.from_user.id
-        if user_id in user_activity:
-            del user_activity[user_id]
-        await cleanup_old_messages(context, user_id, query.message.chat_id)
-        await query.edit_message_text("🔒 Vault locked.\n\nClick the button below to unlock when you're ready.", parse_mode='HTML', reply_markup=get_auth_inline_keyboard())
+        # The session stays until the sweep evicts it; being unauthenticated by then, it gets no second notice
+        cleanup_old_messages(context, user_id, query.message.chat_id, query.message.message_id)
+        await edit_screen(query, LOCKED_TEXT, reply_markup=AUTH_KB)
 
     async def back_to_menu_handler(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
-        await query.edit_message_text("What would you like to do?", parse_mode='HTML', reply_markup=get_main_menu_inline_keyboard())
+        await edit_screen(query, MAIN_MENU_TEXT, reply_markup=MAIN_MENU_KB)
+
+    async def post_init(self, application: Application) -> None:
+        """Initialize the database inside the event loop before the first update is fetched"""
+        if not await run_db(init_db):
+            logger.error("Failed to initialize database. Bot cannot start.")
+            raise RuntimeError("Database initialization failed")
+
+        # Carry over users who were active shortly before the restart, converting their
+        # stored wall-clock times onto this process's monotonic clock
+        wall_now, monotonic_now = time.time(), time.monotonic()
+        for user_id, last_activity, chat_id in await run_db(get_recent_activity, wall_now - INACTIVITY_TIMEOUT):
+            restored = monotonic_now - (wall_now - last_activity)
+            # Rows saved before chat_id was stored fall back to the user id, which is the chat id of a private chat
+            user_state[user_id] = UserState(last_activity=restored, persisted_at=restored, chat_id=chat_id or user_id)
+
+        # Persisted sessions of everyone else have timed out while the bot was down
+        stale_sessions = [
+            user_id for user_id, data in application.user_data.items()
+            if data.get('authenticated') and user_id not in user_state
+        ]
+        for user_id in stale_sessions:
+            application.user_data[user_id]['authenticated'] = False
+            application.user_data[user_id]['state'] = None
+        if stale_sessions:
+            application.mark_data_for_update_persistence(user_ids=stale_sessions)
 
     def run(self):
-        """Start the bot and initialize database"""
-        if init_db():
-            logger.info("Starting VaultBot...")
-            self.application.run_polling()
+        """Start the bot; the database is initialized in post_init"""
+        if WEBHOOK_URL:
+            logger.info(f"Starting VaultBot with webhook on port {WEBHOOK_PORT}...")
+            self.application.run_webhook(
+                listen="0.0.0.0",
+                port=WEBHOOK_PORT,
+                url_path=self.token,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{self.token}",
+                allowed_updates=ALLOWED_UPDATES,
+                secret_token=WEBHOOK_SECRET,
+            )
         else:
-            logger.error("Failed to initialize database. Bot cannot start.")
+            logger.info("Starting VaultBot with long polling...")
+            self.application.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=POLL_TIMEOUT, poll_interval=0.0)
 
 if __name__ == '__main__':
+    # uvloop is optional; without it the default asyncio loop is used
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         bot = VaultBot()
         bot.run()
@@ -1,23 +1,85 @@
-import sqlite3
+# pysqlite3-binary bundles a current SQLite with the same API as the stdlib module;
+# without it the interpreter's own SQLite is used
+try:
+    import pysqlite3 as sqlite3
+except ImportError:
+    import sqlite3
 import bcrypt
+import functools
 import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Users never get removed, so once a user is seen in the DB we can answer
+# user_exists() from memory and skip the query on every /start or unlock.
+_known_users = set()
+
+# Recent misses, oldest first, so a new user tapping /start repeatedly doesn't query
+# every time. Only consulted after _known_users, so signing up never waits on the TTL.
+_unknown_users = OrderedDict()
+_unknown_users_lock = threading.Lock()
+UNKNOWN_USER_TTL = 60
+UNKNOWN_USERS_MAX = 4096
+
+# INSERT ... RETURNING needs SQLite 3.35; older builds fall back to lastrowid and a SELECT
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Bumped whenever init_db gains a migration step; stored in the database's user_version
+SCHEMA_VERSION = 2
+
+# Memo lists of recently active users, least recently used first. Every write
+# to a user's memos goes through this module and updates that user's entry.
+# Calls arrive from worker threads, so the cache is only touched under the lock;
+# the generation stops a read that raced with a write from caching stale rows.
+_memo_cache = OrderedDict()
+_memo_cache_lock = threading.Lock()
+_memo_cache_generation = 0
+MEMO_CACHE_SIZE = 1024
+
+# Open connections reused across calls; the DB and KDF worker threads take one each,
+# and any opened beyond the pool size are closed when they are released
+DB_POOL_SIZE = 8
+_connection_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
+_write_lock = threading.Lock()
+
+# Pooled connections never close, so PRAGMA optimize is run on release every 15 minutes instead
+OPTIMIZE_INTERVAL = 15 * 60
+_last_optimize = time.monotonic()
+
+# New hashes are Argon2id; bcrypt is only kept to verify (and upgrade) legacy hashes.
+# 64 MiB and two passes stay well above OWASP's Argon2id minimum; a single lane keeps
+# each hash on one KDF worker thread instead of fanning out across cores.
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
 def init_db():
     """Initialize the database with required tables"""
     try:
         conn = sqlite3.connect('vaultbot.db', check_same_thread=False)
         cursor = conn.cursor()
 
+        # WAL is stored in the database file, so this sticks for every later connection:
+        # readers no longer wait for writers and commits append to the log instead of rewriting pages
+        cursor.execute("PRAGMA journal_mode=WAL")
+
         # Create users table if it doesn't exist
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 master_password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_activity REAL,
+                chat_id INTEGER
             )
         ''')
 
@@ -34,28 +96,18 @@ def init_db():
             )
         ''')
 
-        # --- Add columns if they don't exist (for upgrading existing DBs) ---
-        # Try to add transcription column
-        try:
-            cursor.execute("ALTER TABLE memos ADD COLUMN transcription TEXT")
-            logger.info("Added 'transcription' column to memos table")
-        except sqlite3.OperationalError as e:
-            if "duplicate column name" in str(e).lower():
-                logger.debug("'transcription' column already exists")
-            else:
-                logger.warning(f"Error adding 'transcription' column: {e}")
-
-        # Try to add summary column
-        try:
-            cursor.execute("ALTER TABLE memos ADD COLUMN summary TEXT")
-            logger.info("Added 'summary' column to memos table")
-        except sqlite3.OperationalError as e:
-             if "duplicate column name" in str(e).lower():
-                logger.debug("'summary' column already exists")
-             else:
-                logger.warning(f"Error adding 'summary' column: {e}")
+        # Schema changes run once per database, gated on user_version, instead of being probed every start
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            _migrate(cursor, version)
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            logger.info(f"Migrated database schema from version {version} to {SCHEMA_VERSION}")
 
         conn.commit()
+
+        # Preload every registered user so user_exists() never needs the DB for them
+        _known_users.update(row[0] for row in cursor.execute('SELECT user_id FROM users'))
+        cursor.execute("PRAGMA optimize")
         conn.close()
         logger.info("Database initialized successfully")
         return True
@@ -63,110 +115,379 @@ def init_db():
         logger.error(f"Database initialization failed: {e}", exc_info=True) # Log full traceback
         return False
 
+def _migrate(cursor, version: int) -> None:
+    """Bring a database at the given user_version up to SCHEMA_VERSION"""
+    if version < 1:
+        # Databases from before versioning may already have some of these columns
+        memo_columns = {row[1] for row in cursor.execute("PRAGMA table_info(memos)")}
+        user_columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+        for table, columns, column, column_type in (
+            ('memos', memo_columns, 'transcription', 'TEXT'),
+            ('memos', memo_columns, 'summary', 'TEXT'),
+            # Unix time of the user's last recorded activity
+            ('users', user_columns, 'last_activity', 'REAL'),
+        ):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                logger.info(f"Added '{column}' column to {table} table")
+
+        # Every memo query filters by owner and the list is newest first, so this index serves
+        # get_user_memos in order without a sort; lookups by id already use the rowid B-tree.
+        # Its user_id prefix covers everything the old single-column index did.
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_memos_user_date ON memos(user_id, date DESC)')
+        cursor.execute('DROP INDEX IF EXISTS idx_memos_user')
+        cursor.execute('ANALYZE')
+
+    if version < 2:
+        # Chat the user was last active in, so a restored session can still get its lock notice
+        if 'chat_id' not in {row[1] for row in cursor.execute("PRAGMA table_info(users)")}:
+            cursor.execute("ALTER TABLE users ADD COLUMN chat_id INTEGER")
+            logger.info("Added 'chat_id' column to users table")
+
 def get_db_connection():
-    """Get a database connection"""
-    return sqlite3.connect('vaultbot.db', check_same_thread=False)
+    """Get a database connection from the pool, opening a new one if the pool is empty"""
+    try:
+        return _connection_pool.get_nowait()
+    except queue.Empty:
+        pass
+    # Autocommit: reads run without an open transaction and writes begin explicitly in transaction()
+    conn = sqlite3.connect('vaultbot.db', check_same_thread=False, isolation_level=None)
+    # In WAL mode NORMAL only syncs at checkpoints; a crash can lose the last commits but never corrupts
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Reads of the (small) database file become memory loads instead of pread() calls
+    conn.execute("PRAGMA mmap_size=268435456")
+    # Up to 20 MB page cache; pooled connections keep it warm across calls and it only grows with the data
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+def release_db_connection(conn):
+    """Return a connection to the pool, closing it if the pool is already full"""
+    global _last_optimize
+    now = time.monotonic()
+    if now - _last_optimize > OPTIMIZE_INTERVAL:
+        _last_optimize = now
+        try:
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            logger.warning(f"PRAGMA optimize failed: {e}")
+    try:
+        _connection_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@contextmanager
+def borrow():
+    """Borrow a pooled connection; one that hit a database error is closed instead of reused"""
+    conn = get_db_connection()
+    try:
+        yield conn
+    except sqlite3.Error:
+        conn.close()
+        raise
+    except BaseException:
+        conn.rollback()
+        release_db_connection(conn)
+        raise
+    release_db_connection(conn)
+
+@contextmanager
+def transaction():
+    """Borrow a connection for a unit of work that commits once at the end, or rolls back"""
+    # WAL allows one writer at a time; queuing writers on a lock here is cheaper than
+    # letting them collide and back off in SQLite's busy handler. Reads never take it.
+    with _write_lock, borrow() as conn:
+        # IMMEDIATE takes the write lock up front rather than upgrading a read lock mid-transaction
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            yield conn
 
 # --- Database Interaction Functions ---
+def is_known_user(user_id: int) -> bool:
+    """Memory-only check; False means 'not seen yet', not 'does not exist'"""
+    return user_id in _known_users
+
+def _recently_unknown(user_id: int) -> bool:
+    with _unknown_users_lock:
+        missed_at = _unknown_users.get(user_id)
+        if missed_at is None:
+            return False
+        if time.monotonic() - missed_at < UNKNOWN_USER_TTL:
+            return True
+        del _unknown_users[user_id]
+        return False
+
+def _remember_unknown(user_id: int) -> None:
+    with _unknown_users_lock:
+        _unknown_users.pop(user_id, None)
+        _unknown_users[user_id] = time.monotonic()
+        if len(_unknown_users) > UNKNOWN_USERS_MAX:
+            _unknown_users.popitem(last=False)
+
 def user_exists(user_id: int) -> bool:
+    if user_id in _known_users:
+        return True
+    if _recently_unknown(user_id):
+        return False
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        logger.debug(f"User existence check for {user_id}: {exists}")
+        with borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
+            exists = cursor.fetchone() is not None
+        if exists:
+            _known_users.add(user_id)
+        else:
+            _remember_unknown(user_id)
+        logger.debug("User existence check for %s: %s", user_id, exists)
         return exists
     except Exception as e:
         logger.error(f"Error checking user existence: {e}")
         return False
 
 def set_master_password(user_id: int, password: str) -> bool:
+    """Register a new user's password; an existing password is never overwritten"""
+    if user_id in _known_users:
+        logger.warning(f"Refusing to replace the password of existing user {user_id}")
+        return False
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute('INSERT OR REPLACE INTO users (user_id, master_password_hash) VALUES (?, ?)', (user_id, password_hash))
-        conn.commit()
-        conn.close()
-        logger.info(f"Password set successfully for user {user_id}")
+        # Hash before borrowing so the slow KDF never holds a pooled connection
+        password_hash = _password_hasher.hash(password)
+        with transaction() as conn:
+            cursor = conn.cursor()
+            # The existence check and the insert are one statement, so a concurrent signup can't be clobbered
+            cursor.execute('INSERT INTO users (user_id, master_password_hash) VALUES (?, ?) ON CONFLICT(user_id) DO NOTHING', (user_id, password_hash))
+            inserted = cursor.rowcount == 1
+        _known_users.add(user_id)
+        if not inserted:
+            logger.warning(f"Refusing to replace the password of existing user {user_id}")
+            return False
+        logger.info("Password set successfully for user %s", user_id)
         return True
     except Exception as e:
         logger.error(f"Error setting password for user {user_id}: {e}")
         return False
 
+@functools.lru_cache(maxsize=1)
+def _dummy_hash() -> str:
+    """An Argon2id hash with the current parameters that no user has, made on first use"""
+    return _password_hasher.hash(os.urandom(16).hex())
+
+def _reject_unknown_user(user_id: int, password: str) -> bool:
+    """Spend the same KDF work as a wrong password, so timing doesn't reveal who is registered"""
+    try:
+        _password_hasher.verify(_dummy_hash(), password)
+    except VerificationError:
+        pass
+    logger.warning("No password found for user %s", user_id)
+    return False
+
 def verify_master_password(user_id: int, password: str) -> bool:
+    # Known users are answered from memory; unknown ones never reach the password query
+    if not user_exists(user_id):
+        return _reject_unknown_user(user_id, password)
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT master_password_hash FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT master_password_hash FROM users WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
 
         if result is None:
-            logger.warning(f"No password found for user {user_id}")
-            return False
+            return _reject_unknown_user(user_id, password)
 
         stored_hash = result[0]
-        is_valid = bcrypt.checkpw(password.encode('utf-8'), stored_hash)
-        logger.info(f"Password verification for user {user_id}: {is_valid}")
+        if isinstance(stored_hash, bytes):
+            # Legacy bcrypt hash: verify it, then upgrade the stored hash to Argon2id
+            is_valid = bcrypt.checkpw(password.encode('utf-8'), stored_hash)
+            if is_valid:
+                _upgrade_password_hash(user_id, password)
+        else:
+            try:
+                is_valid = _password_hasher.verify(stored_hash, password)
+            except VerificationError:
+                is_valid = False
+            # Hashes made with older parameters are redone with the current ones
+            if is_valid and _password_hasher.check_needs_rehash(stored_hash):
+                _upgrade_password_hash(user_id, password)
+        logger.info("Password verification for user %s: %s", user_id, is_valid)
         return is_valid
     except Exception as e:
         logger.error(f"Error verifying password for user {user_id}: {e}")
         return False
 
-def save_voice_memo(user_id: int, file_id: str) -> bool:
+def _upgrade_password_hash(user_id: int, password: str) -> None:
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO memos (user_id, file_id) VALUES (?, ?)', (user_id, file_id))
-        conn.commit()
-        conn.close()
-        logger.info(f"Voice memo saved for user {user_id} with file_id {file_id}")
+        password_hash = _password_hasher.hash(password)
+        with transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE users SET master_password_hash = ? WHERE user_id = ?', (password_hash, user_id))
+        logger.info("Upgraded password hash for user %s", user_id)
+    except Exception as e:
+        logger.error(f"Error upgrading password hash for user {user_id}: {e}")
+
+def save_user_activity(user_id: int, timestamp: float, chat_id: int) -> bool:
+    try:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE users SET last_activity = ?, chat_id = ? WHERE user_id = ?', (timestamp, chat_id, user_id))
         return True
     except Exception as e:
-        logger.error(f"Error saving voice memo for user {user_id}: {e}")
+        logger.error(f"Error saving activity for user {user_id}: {e}")
         return False
 
+def get_recent_activity(since: float) -> List[Tuple[int, float, Optional[int]]]:
+    """(user_id, last_activity, chat_id) of every user active after the given unix time, oldest first"""
+    try:
+        with borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, last_activity, chat_id FROM users WHERE last_activity > ? ORDER BY last_activity', (since,))
+            rows = cursor.fetchall()
+        return rows
+    except Exception as e:
+        logger.error(f"Error loading recent user activity: {e}")
+        return []
+
+def save_voice_memo(user_id: int, file_id: str) -> Optional[Dict]:
+    """Store a memo and return it as a memo-list entry, or None if it couldn't be saved"""
+    try:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            # The generated id and date are read back so the cached list can be extended without a re-read
+            if HAS_RETURNING:
+                cursor.execute('INSERT INTO memos (user_id, file_id) VALUES (?, ?) RETURNING id, date', (user_id, file_id))
+                memo_id, date = cursor.fetchone()
+            else:
+                cursor.execute('INSERT INTO memos (user_id, file_id) VALUES (?, ?)', (user_id, file_id))
+                memo_id = cursor.lastrowid
+                cursor.execute('SELECT date FROM memos WHERE id = ?', (memo_id,))
+                date = cursor.fetchone()[0]
+        memo = {'id': memo_id, 'file_id': file_id, 'date': date, 'day': date.split()[0] if date else date}
+        _cache_add_memo(user_id, memo)
+        logger.debug("Voice memo saved for user %s with file_id %s", user_id, file_id)
+        return memo
+    except Exception as e:
+        logger.error(f"Error saving voice memo for user {user_id}: {e}")
+        return None
+
+def _cache_get(user_id: int) -> Optional[List[Dict]]:
+    with _memo_cache_lock:
+        cached = _memo_cache.get(user_id)
+        if cached is not None:
+            _memo_cache.move_to_end(user_id)
+        return cached
+
+def _cache_put(user_id: int, memos: List[Dict], generation: int) -> None:
+    with _memo_cache_lock:
+        if generation != _memo_cache_generation:
+            return
+        _memo_cache[user_id] = memos
+        if len(_memo_cache) > MEMO_CACHE_SIZE:
+            _memo_cache.popitem(last=False)
+
+def _cache_add_memo(user_id: int, memo: Dict) -> None:
+    """Put a new memo at the top of the user's cached list, which is newest first"""
+    global _memo_cache_generation
+    with _memo_cache_lock:
+        _memo_cache_generation += 1
+        cached = _memo_cache.get(user_id)
+        if cached is not None:
+            _memo_cache[user_id] = [memo] + cached
+
+def _cache_discard_memo(user_id: int, memo_id: int) -> None:
+    """Drop one memo from the user's cached list, keeping the rest of the entry warm"""
+    global _memo_cache_generation
+    with _memo_cache_lock:
+        _memo_cache_generation += 1
+        cached = _memo_cache.get(user_id)
+        if cached is not None:
+            _memo_cache[user_id] = [memo for memo in cached if memo['id'] != memo_id]
+
 def get_user_memos(user_id: int) -> List[Dict]:
+    cached = _cache_get(user_id)
+    if cached is not None:
+        return list(cached)
+    generation = _memo_cache_generation
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, file_id, date FROM memos WHERE user_id = ? ORDER BY date DESC', (user_id,))
-        memos = []
-        for row in cursor.fetchall():
-            memos.append({'id': row[0], 'file_id': row[1], 'date': row[2]})
-        conn.close()
-        logger.debug(f"Retrieved {len(memos)} memos for user {user_id}")
-        return memos
+        with borrow() as conn:
+            cursor = conn.cursor()
+            # 'day' is the date part of the timestamp, split once here rather than on every render;
+            # rows are unpacked straight off the cursor without an intermediate fetchall() list
+            memos = [
+                {'id': memo_id, 'file_id': file_id, 'date': date, 'day': date.split()[0] if date else date}
+                for memo_id, file_id, date in cursor.execute('SELECT id, file_id, date FROM memos WHERE user_id = ? ORDER BY date DESC', (user_id,))
+            ]
+        logger.debug("Retrieved %d memos for user %s", len(memos), user_id)
+        _cache_put(user_id, memos, generation)
+        return list(memos)
     except Exception as e:
         logger.error(f"Error retrieving memos for user {user_id}: {e}")
         return []
 
-def get_memo_file_id(memo_id: int, user_id: int) -> Optional[str]:
+def _cached_memo(memo_id: int, user_id: int) -> Optional[Dict]:
+    """The memo from the user's cached list, or None if the list isn't cached or lacks it"""
+    cached = _cache_get(user_id)
+    if cached is None:
+        return None
+    return next((memo for memo in cached if memo['id'] == memo_id), None)
+
+def get_memo_file_info(memo_id: int, user_id: int) -> Optional[Tuple[str, str]]:
+    """(file_id, day) of one of the user's memos, or None if it doesn't exist or isn't theirs"""
+    # The list a user just tapped from is almost always cached; ownership is implied by whose list it is
+    memo = _cached_memo(memo_id, user_id)
+    if memo is not None:
+        return memo['file_id'], memo['day']
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT file_id FROM memos WHERE id = ? AND user_id = ?', (memo_id, user_id))
-        result = cursor.fetchone()
-        conn.close()
+        with borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT file_id, date FROM memos WHERE id = ? AND user_id = ?', (memo_id, user_id))
+            result = cursor.fetchone()
         if result:
-            return result[0]
+            return result[0], result[1].split()[0] if result[1] else result[1]
         return None
     except Exception as e:
         logger.error(f"Error getting memo file_id for memo {memo_id}, user {user_id}: {e}")
         return None
 
+def get_memo_texts(memo_id: int, user_id: int) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """(transcription, summary) of one of the user's memos, or None if it doesn't exist or isn't theirs"""
+    try:
+        with borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT transcription, summary FROM memos WHERE id = ? AND user_id = ?', (memo_id, user_id))
+            result = cursor.fetchone()
+        return (result[0], result[1]) if result else None
+    except Exception as e:
+        logger.error(f"Error getting transcription/summary for memo {memo_id}, user {user_id}: {e}")
+        return None
+
+def save_memo_transcription(memo_id: int, user_id: int, transcription: str) -> bool:
+    try:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE memos SET transcription = ? WHERE id = ? AND user_id = ?', (transcription, memo_id, user_id))
+        return True
+    except Exception as e:
+        logger.error(f"Error saving transcription for memo {memo_id}, user {user_id}: {e}")
+        return False
+
+def save_memo_summary(memo_id: int, user_id: int, summary: str) -> bool:
+    try:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE memos SET summary = ? WHERE id = ? AND user_id = ?', (summary, memo_id, user_id))
+        return True
+    except Exception as e:
+        logger.error(f"Error saving summary for memo {memo_id}, user {user_id}: {e}")
+        return False
+
 def delete_memo(memo_id: int, user_id: int) -> bool:
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM memos WHERE id = ? AND user_id = ?', (memo_id, user_id))
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM memos WHERE id = ? AND user_id = ?', (memo_id, user_id))
+            success = cursor.rowcount > 0
+        _cache_discard_memo(user_id, memo_id)
         if success:
-            logger.info(f"Deleted memo {memo_id} for user {user_id}")
+            logger.debug("Deleted memo %s for user %s", memo_id, user_id)
         else:
             logger.warning(f"Attempted to delete memo {memo_id} for user {user_id}, but it was not found.")
         return success